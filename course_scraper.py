@@ -1,24 +1,37 @@
 import os
-import json
 import re
+import queue
+import asyncio
+import threading
+import httpx
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urljoin
-from markdownify import markdownify as md
+import html2text
 from playwright.sync_api import sync_playwright
-from pathlib import PurePosixPath
+from pathlib import Path, PurePosixPath
 
 # CONFIGURATION
 BASE_URL = "https://tds.s-anand.net/#/2025-01/"
 OUTPUT_DIR = "tds_markdown"
 METADATA_FILE = "metadata.json"
+WORKERS = 8
+MAX_CONNECTIONS = 32
 
-# State
+# Precompiled patterns and translation tables
+_BAD_FILENAME_CHARS = str.maketrans(dict.fromkeys('\\/*?:"<>|', "_"))
+_UNSAFE_CHARS_RE = re.compile(r"[^\w\-.]")
+_TITLE_RE = re.compile(r"^#\s+(.+)$", re.MULTILINE)
+
+# State (shared across crawler threads)
 visited = set()
 metadata = []
+state_lock = threading.Lock()
 
 def sanitize_filename(title):
     """Remove invalid filename characters."""
-    return re.sub(r'[\/*?:"<>|]', "_", title).strip().replace(" ", "_")
+    return title.translate(_BAD_FILENAME_CHARS).strip().replace(" ", "_")
 
 def extract_sidebar_links(page):
     """Get unique hrefs from sidebar."""
@@ -32,20 +45,26 @@ def wait_for_main_article(page):
     return page.inner_html("article.markdown-section#main")
 
 
-def crawl_page(page, url):
-    if url in visited:
+def load_previous_run():
+    """Seed state from an earlier run's metadata so saved pages are not fetched again."""
+    if not os.path.exists(METADATA_FILE):
         return
-    visited.add(url)
+    for entry in orjson.loads(Path(METADATA_FILE).read_bytes()):
+        if os.path.exists(os.path.join(OUTPUT_DIR, entry["filename"])):
+            metadata.append(entry)
+            visited.add(entry["original_url"])
+
+
+def html_to_markdown(html):
+    """Convert rendered article HTML to Markdown."""
+    # HTML2Text accumulates parser state, so use a fresh converter per page
+    converter = html2text.HTML2Text()
+    converter.body_width = 0  # don't hard-wrap lines
+    return converter.handle(html).strip()
 
-    print(f"📄 Visiting: {url}")
-    try:
-        page.goto(url, wait_until="domcontentloaded")
-        page.wait_for_timeout(300)  # wait for JS to finish loading
-        html = wait_for_main_article(page)
-    except Exception as e:
-        print(f"❌ Failed: {url} — {e}")
-        return
 
+def url_to_filename(url):
+    """Map a #/ page URL to its local markdown filename."""
     # Extract slug from #/ path (e.g., 'data-sourcing/scraping-imdb-with-javascript.md')
     raw_path = url.split("#/")[-1].strip("/")
     filename = PurePosixPath(raw_path).name  # gets just 'scraping-imdb-with-javascript.md'
@@ -56,34 +75,106 @@ def crawl_page(page, url):
 
     # Clean and sanitize filename
     filename = filename.lower().replace(" ", "-")
-    filename = re.sub(r"[^\w\-.]", "_", filename)
-
+    return _UNSAFE_CHARS_RE.sub("_", filename)
+
+def markdown_source_url(url):
+    """Map a #/ page URL to the static .md file it is rendered from."""
+    path = url.split("#/", 1)[-1].split("?", 1)[0]
+    if not path or path.endswith("/"):
+        path += "README.md"
+    elif not path.endswith(".md"):
+        path += ".md"
+    return urljoin(url.split("#", 1)[0], path)
+
+def save_page(url, filename, title, markdown):
+    """Write the page with frontmatter and record its metadata."""
     filepath = os.path.join(OUTPUT_DIR, filename)
 
-    # Convert HTML to Markdown
-    markdown = md(html).strip()
-
-    # Save the Markdown file with frontmatter
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write("---\n")
-        f.write(f'title: "{page.title().split(" - ")[0].strip()}"\n')
-        f.write(f'original_url: "{url}"\n')
-        f.write(f'downloaded_at: "{datetime.now().isoformat()}"\n')
-        f.write("---\n\n")
-        f.write(markdown)
+    # Save the Markdown file with frontmatter in a single write
+    frontmatter = "\n".join([
+        f'title: "{title}"',
+        f'original_url: "{url}"',
+        f'downloaded_at: "{datetime.now().isoformat()}"',
+    ])
+    Path(filepath).write_text(f"---\n{frontmatter}\n---\n\n{markdown}", encoding="utf-8")
 
     # Save metadata for reference
-    metadata.append({
-        "title": page.title().split(" - ")[0].strip(),
-        "filename": filename,
-        "original_url": url,
-        "downloaded_at": datetime.now().isoformat()
-    })
+    with state_lock:
+        metadata.append({
+            "title": title,
+            "filename": filename,
+            "original_url": url,
+            "downloaded_at": datetime.now().isoformat()
+        })
+
+
+async def fetch_page(client, url):
+    """Fetch the page's markdown source directly. Returns False if it must be rendered."""
+    try:
+        response = await client.get(markdown_source_url(url))
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"⚠️ Direct fetch failed: {url} — {e}")
+        return False
+    if "text/html" in response.headers.get("content-type", ""):
+        return False
+
+    markdown = response.text.strip()
+    filename = url_to_filename(url)
+    heading = _TITLE_RE.search(markdown)
+    title = heading.group(1).strip() if heading else PurePosixPath(filename).stem
+    print(f"📄 Fetched: {url}")
+    save_page(url, filename, title, markdown)
+    return True
+
+async def fetch_all(links):
+    """Fetch all pages concurrently. Returns the links that still need a browser."""
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=30, follow_redirects=True) as client:
+        results = await asyncio.gather(*(fetch_page(client, link) for link in links))
+    return [link for link, ok in zip(links, results) if not ok]
+
+
+def crawl_page(page, url):
+    with state_lock:
+        if url in visited:
+            return
+        visited.add(url)
 
+    print(f"📄 Visiting: {url}")
+    try:
+        page.goto(url, wait_until="domcontentloaded")
+        page.wait_for_load_state("networkidle")
+        html = wait_for_main_article(page)
+        title = page.title().split(" - ")[0].strip()
+    except Exception as e:
+        print(f"❌ Failed: {url} — {e}")
+        return
+
+    # Convert HTML to Markdown
+    markdown = html_to_markdown(html)
+    save_page(url, url_to_filename(url), title, markdown)
+
+
+def crawl_worker(urls):
+    """Crawl queued URLs until the queue is empty."""
+    # Playwright's sync API is bound to its thread, so each worker owns a browser
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        context = browser.new_context()
+        page = context.new_page()
+        while True:
+            try:
+                url = urls.get_nowait()
+            except queue.Empty:
+                break
+            crawl_page(page, url)
+        browser.close()
 
 
 def main():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    load_previous_run()
     print("🌍 Launching browser...")
 
     with sync_playwright() as p:
@@ -105,15 +196,28 @@ def main():
 
         links = extract_sidebar_links(page)
         print(f"🔗 Found {len(links)} sidebar links.")
+        browser.close()
 
-        for link in links:
-            crawl_page(page, link)
+    # Only pages with a metadata entry count as done; an .md without one is fetched
+    # again so metadata.json never loses it
+    pending = [link for link in links if link not in visited]
+    print(f"⏭️ Skipping {len(links) - len(pending)} already downloaded pages.")
 
-        with open(METADATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, indent=2)
+    # Article pages are static markdown; only fall back to a browser when that fails
+    remaining = asyncio.run(fetch_all(pending))
 
-        print(f"✅ Done! {len(metadata)} files saved.")
-        browser.close()
+    if remaining:
+        print(f"🌍 Rendering {len(remaining)} pages with the browser...")
+        urls = queue.Queue()
+        for link in remaining:
+            urls.put(link)
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            list(executor.map(crawl_worker, [urls] * min(WORKERS, len(remaining))))
+
+    Path(METADATA_FILE).write_bytes(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+
+    print(f"✅ Done! {len(metadata)} files saved.")
 
 
 if __name__ == "__main__":
@@ -1,22 +1,42 @@
+import io
 import os
 import re
-import time
+import sys
 import json
+import asyncio
+import sqlite3
+import hashlib
 import numpy as np
 import tiktoken
+import zstandard as zstd
 from tqdm import tqdm
 from pathlib import Path
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 
 OPENAI_API_KEY = os.getenv("API_KEY")
 MODEL = "text-embedding-3-small"
 CHUNK_SIZE = 200
 OVERLAP = 50
-SUBCHUNK_TOKENS = 150
-OUTPUT_FILE = "embeddings.npz"
+STRIDE = CHUNK_SIZE - OVERLAP
+OUTPUT_FILE = "embeddings.npz.zst"
+CACHE_FILE = "emb_cache.db"
+EMBEDDINGS_BUFFER = "embeddings.dat"
+DIMENSIONS = 512
+MAX_BATCH_ITEMS = 2048
+MAX_BATCH_TOKENS = 280000
+INPUT_ERROR_STATUSES = {400, 413, 422}
+FATAL_STATUSES = {401, 403, 404}
+MAX_CONCURRENCY = 3  # full bins are ~280k tokens, so ~840k tokens in flight
+ENCODE_THREADS = os.cpu_count() or 8
+QUANTIZE_BLOCK_ROWS = 4096
+
+# --- Precompiled Patterns ---
+_SLUG_ID_RE = re.compile(r"(\d+)_([^.]+)\.md")
+_POST_RE = re.compile(r"-{3,}\n\*{2}")
+_HEADER_RE = re.compile(r"(.*?)\*\* posted on (.*?):\n\n")
 
 # --- Setup ---
-client = OpenAI(api_key=OPENAI_API_KEY, base_url="https://aipipe.org/openai/v1")
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url="https://aipipe.org/openai/v1")
 enc = tiktoken.encoding_for_model(MODEL)
 
 # --- Utilities ---
@@ -24,138 +44,300 @@ def slugify(name):
     return name.lower().replace("_", "-").replace(" ", "-")
 
 def extract_slug_id(filename):
-    match = re.match(r"(\d+)_([^.]+)\.md", filename)
+    match = _SLUG_ID_RE.match(filename)
     if match:
         topic_id = match.group(1)
         slug = match.group(2)
         return slug, topic_id
     return None, None
 
+# --- Sliding Token Window ---
+def sliding_window(ids):
+    # (text, n_tokens) windows of CHUNK_SIZE tokens every STRIDE tokens. The last window
+    # is full-size and ends at the tail; a regular window before it (other than the first)
+    # is dropped when it would leave the tail at most OVERLAP new tokens. The gap that
+    # leaves is at most STRIDE + OVERLAP = CHUNK_SIZE, so every token stays covered.
+    # Edges can split a multi-byte character, so drop partial bytes instead of emitting U+FFFD
+    last = max(len(ids) - CHUNK_SIZE, 0)
+    starts = list(range(0, last, STRIDE))
+    if len(starts) > 1 and last - starts[-1] <= OVERLAP:
+        starts.pop()
+    starts.append(last)
+
+    windows = []
+    for i in starts:
+        window = ids[i:i + CHUNK_SIZE]
+        windows.append((enc.decode_bytes(window).decode("utf-8", errors="ignore"), len(window)))
+    return windows
+
 # --- Chunk Markdown Notes ---
 def split_course_markdown(text):
-    sections = re.split(r"^#+\s+", text, flags=re.MULTILINE)
-    chunks = []
-    for section in sections:
-        paras = section.strip().split("\n\n")
-        current, current_len = [], 0
-        for para in paras:
-            tokens = len(enc.encode(para))
-            if current_len + tokens > CHUNK_SIZE:
-                chunk = "\n\n".join(current)
-                chunks.append(chunk)
-                current = [para]
-                current_len = tokens
-            else:
-                current.append(para)
-                current_len += tokens
-        if current:
-            chunks.append("\n\n".join(current))
-    return chunks
+    return [(chunk, tokens) for chunk, tokens in sliding_window(enc.encode_ordinary(text)) if chunk.strip()]
 
 # --- Chunk Discourse Posts ---
 def chunk_discourse_file(text):
-    chunks = []
-    post_blocks = re.split(r"-{3,}\n\*{2}", text)
+    # One group of (text, n_tokens) per post; posts longer than CHUNK_SIZE become
+    # several windows, each prefixed with the post header
+    posts = []
+    post_blocks = _POST_RE.split(text)
     for post in post_blocks:
         post = post.strip()
         if not post:
             continue
-        header_match = re.match(r"(.*?)\*\* posted on (.*?):\n\n", post)
+        header_match = _HEADER_RE.match(post)
         if header_match:
             meta = header_match.group(0)
             body = post[len(meta):].strip()
-            chunks.append(f"{meta}{body}")
+            posts.append((meta, body))
         else:
-            chunks.append(post)
-    return chunks
-
-# --- Split Large Chunks ---
-def split_large_chunk(text, max_tokens=SUBCHUNK_TOKENS):
-    words = text.split()
-    subchunks = []
-    for i in range(0, len(words), max_tokens - OVERLAP):
-        sub = " ".join(words[i:i + max_tokens])
-        if sub:
-            subchunks.append(sub)
-    return subchunks
-
-# --- Get Embedding with Retry ---
-def get_embedding(text, max_retries=3):
+            posts.append(("", post))
+
+    # Headers and bodies are tokenized in one pass; a chunk's count is header + body,
+    # which is what batching needs without re-encoding the joined text
+    encoded = enc.encode_ordinary_batch(
+        [meta for meta, _ in posts] + [body for _, body in posts], num_threads=ENCODE_THREADS
+    )
+    groups = []
+    for (meta, body), meta_ids, ids in zip(posts, encoded[:len(posts)], encoded[len(posts):]):
+        if len(ids) <= CHUNK_SIZE:
+            groups.append([(f"{meta}{body}", len(meta_ids) + len(ids))])
+        else:
+            groups.append([(f"{meta}{window}", len(meta_ids) + tokens) for window, tokens in sliding_window(ids)])
+    return groups
+
+# --- Embed a Batch with Retry ---
+def retry_delay(error, attempt):
+    # Honour Retry-After on 429/5xx, else back off exponentially
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return 2 ** attempt
+
+async def embed_batch(texts, sem, max_retries=3):
+    # Returns the embeddings, or raises the last error once retries are exhausted
     for attempt in range(max_retries):
         try:
-            tokens = len(enc.encode(text))
-            if tokens > 8192:
-                print(f"⚠️ Chunk too large ({tokens} tokens). Splitting...")
-                embeddings = []
-                for sub in split_large_chunk(text):
-                    sub_emb = get_embedding(sub)
-                    if sub_emb:
-                        embeddings.append((sub, sub_emb))
-                return embeddings if embeddings else None
-
-            response = client.embeddings.create(
-                model=MODEL,
-                input=text,
-                dimensions=512
-            )
-            return response.data[0].embedding
+            # Hold a concurrency slot only for the request itself, not the backoff
+            async with sem:
+                response = await client.embeddings.create(
+                    model=MODEL,
+                    input=texts,
+                    dimensions=DIMENSIONS
+                )
+            return [d.embedding for d in response.data]
+        except (APIConnectionError, APIStatusError) as e:
+            retryable = not isinstance(e, APIStatusError) or e.status_code == 429 or e.status_code >= 500
+            print(f"⚠️ Failed to embed batch of {len(texts)} (attempt {attempt + 1}): {e}")
+            if not retryable or attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+
+async def embed_all(texts, batches, on_batch):
+    # on_batch(batch, embeddings) runs as soon as each batch returns, so results
+    # are persisted even if a later batch fails or the run is interrupted
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def run(batch, top_level=True):
+        try:
+            embeddings = await embed_batch([texts[idx] for idx in batch], sem)
+        except APIStatusError as e:
+            if e.status_code in FATAL_STATUSES:
+                raise  # bad key, model or base_url: every other request would fail too
+            if e.status_code in INPUT_ERROR_STATUSES and len(batch) > 1:
+                # Rejected input: split and retry the halves so only the bad item is lost
+                mid = len(batch) // 2
+                print(f"↪️ Retrying rejected batch of {len(batch)} as two halves...")
+                await asyncio.gather(run(batch[:mid], False), run(batch[mid:], False))
+            else:
+                print(f"❌ Dropping batch of {len(batch)}: {e}")
         except Exception as e:
-            print(f"⚠️ Failed to embed (attempt {attempt + 1}): {e}")
-            time.sleep(2 ** attempt)
-    return None
+            # e.g. throttling that outlasted its retries or a malformed proxy response;
+            # splitting would only add load, so drop this batch but keep the run going
+            print(f"❌ Dropping batch of {len(batch)}: {e!r}")
+        else:
+            on_batch(batch, embeddings)
+        if top_level:
+            progress.update(1)
+
+    with tqdm(total=len(batches), desc="Embedding batches") as progress:
+        await asyncio.gather(*(run(batch) for batch in batches))
+
+# --- Group Chunks into Request-Sized Batches ---
+def make_batches(token_counts):
+    # First-fit decreasing: largest chunks first, each into the first batch with room
+    batches, loads = [], []
+    for idx in sorted(range(len(token_counts)), key=token_counts.__getitem__, reverse=True):
+        tokens = token_counts[idx]
+        for b, batch in enumerate(batches):
+            if len(batch) < MAX_BATCH_ITEMS and loads[b] + tokens <= MAX_BATCH_TOKENS:
+                batch.append(idx)
+                loads[b] += tokens
+                break
+        else:
+            batches.append([idx])
+            loads.append(tokens)
+    return batches
+
+# --- Int8 Scalar Quantization ---
+def quantize(vecs, rows):
+    # Quantize vecs[rows] in blocks so only one block of float temporaries is resident
+    q = np.empty((len(rows), vecs.shape[1]), dtype=np.int8)
+    scales = np.empty((len(rows), 1), dtype=np.float32)
+    for start in range(0, len(rows), QUANTIZE_BLOCK_ROWS):
+        block = vecs[rows[start:start + QUANTIZE_BLOCK_ROWS]]
+        block_scales = np.max(np.abs(block), axis=1, keepdims=True) / 127
+        block_scales[block_scales == 0] = 1
+        q[start:start + len(block)] = np.round(block / block_scales)
+        scales[start:start + len(block)] = block_scales
+    return q, scales
+
+# --- Zstandard-Compressed Archive ---
+class _UntellableStream:
+    # Hides the zstd writer's tell(), which counts compressed bytes and would corrupt
+    # the zip offsets, so zipfile tracks positions itself. numpy only treats objects
+    # with a read attribute as files, hence the stub.
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, data):
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def read(self, *args):
+        raise io.UnsupportedOperation("write-only stream")
+
+def save_archive(path, **arrays):
+    # Plain (stored) npz streamed through multi-threaded zstd; no in-memory copy
+    cctx = zstd.ZstdCompressor(level=3, threads=-1)
+    with open(path, "wb") as f, cctx.stream_writer(f) as writer:
+        np.savez(_UntellableStream(writer), **arrays)
+
+# --- Persistent Embedding Cache ---
+def open_cache(path=CACHE_FILE):
+    cache = sqlite3.connect(path)
+    cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+    return cache
+
+def cache_key(text):
+    # Vector width is part of the key, so changing DIMENSIONS is a cache miss, not a bad row
+    return hashlib.sha256(f"{MODEL}\0{DIMENSIONS}\0{text}".encode("utf-8")).digest()
+
+# --- Build Chunk Metadata ---
+def build_meta(file_path, is_discourse, chunk_id, text, post_index):
+    meta = {
+        "filename": str(file_path),
+        "chunk_id": chunk_id,
+        "text": text[:200].replace("\n", " ")
+    }
+    if is_discourse:
+        slug, topic_id = extract_slug_id(file_path.name)
+        if slug and topic_id:
+            meta["url"] = f"https://discourse.onlinedegree.iitm.ac.in/t/{slug}/{topic_id}/{post_index}"
+    else:
+        slug = slugify(file_path.stem)
+        meta["url"] = f"https://tds.s-anand.net/#/{slug}"
+    return meta
 
 # --- Main Embedding Generator ---
 if __name__ == "__main__":
     folders = ["tds_markdown", "tds_discourse_md"]
-    all_chunks, all_embeddings, metas = [], [], []
 
     files = []
     for folder in folders:
         files.extend(Path(folder).rglob("*.md"))
 
+    # Gather every (chunk, meta) pair first so they can be embedded in batches
+    items = []
     for file_path in tqdm(files, desc="Processing files"):
         with open(file_path, encoding="utf-8") as f:
             text = f.read()
 
         is_discourse = "tds_discourse_md" in str(file_path)
-        chunks = chunk_discourse_file(text) if is_discourse else split_course_markdown(text)
-
-        for i, chunk in enumerate(chunks):
-            embedding = get_embedding(chunk)
-            if embedding:
-                if isinstance(embedding, list) and isinstance(embedding[0], tuple):
-                    for j, (subchunk, emb) in enumerate(embedding):
-                        meta = {
-                            "filename": str(file_path),
-                            "chunk_id": f"{i}_{j}",
-                            "text": subchunk[:200].replace("\n", " ")
-                        }
-                        if is_discourse:
-                            slug, topic_id = extract_slug_id(file_path.name)
-                            if slug and topic_id:
-                                meta["url"] = f"https://discourse.onlinedegree.iitm.ac.in/t/{slug}/{topic_id}/{i}"
-                        else:
-                            slug = slugify(file_path.stem)
-                            meta["url"] = f"https://tds.s-anand.net/#/{slug}"
-                        all_chunks.append(subchunk)
-                        all_embeddings.append(emb)
-                        metas.append(meta)
-                else:
-                    meta = {
-                        "filename": str(file_path),
-                        "chunk_id": i,
-                        "text": chunk[:200].replace("\n", " ")
-                    }
-                    if is_discourse:
-                        slug, topic_id = extract_slug_id(file_path.name)
-                        if slug and topic_id:
-                            meta["url"] = f"https://discourse.onlinedegree.iitm.ac.in/t/{slug}/{topic_id}/{i}"
-                    else:
-                        slug = slugify(file_path.stem)
-                        meta["url"] = f"https://tds.s-anand.net/#/{slug}"
-                    all_chunks.append(chunk)
-                    all_embeddings.append(embedding)
-                    metas.append(meta)
-
-    np.savez_compressed(OUTPUT_FILE, chunks=all_chunks, embeddings=np.array(all_embeddings), metadata=metas)
+        if is_discourse:
+            groups = chunk_discourse_file(text)
+        else:
+            groups = [[pair] for pair in split_course_markdown(text)]
+
+        for i, group in enumerate(groups):
+            for j, (chunk, tokens) in enumerate(group):
+                chunk_id = f"{i}_{j}" if len(group) > 1 else i
+                items.append((chunk, build_meta(file_path, is_discourse, chunk_id, chunk, i), tokens))
+
+    # Embed each distinct chunk once; quoted replies and signatures repeat a lot
+    unique, texts, token_counts, rows_of = {}, [], [], []
+    for row, (chunk, _, tokens) in enumerate(items):
+        h = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+        if h not in unique:
+            unique[h] = len(texts)
+            texts.append(chunk)
+            token_counts.append(tokens)
+            rows_of.append([])
+        rows_of[unique[h]].append(row)
+    print(f"🧮 {len(texts)} unique chunks out of {len(items)}.")
+
+    # Vectors are written straight into a disk-backed buffer, one row per item
+    mm = np.memmap(EMBEDDINGS_BUFFER, dtype=np.float32, mode="w+", shape=(len(items), DIMENSIONS))
+    embedded = np.zeros(len(items), dtype=bool)
+
+    # Only chunks not already in the on-disk cache hit the network
+    cache = open_cache()
+    keys = [cache_key(text) for text in texts]
+    misses = []
+    for u, key in enumerate(keys):
+        row = cache.execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row:
+            mm[rows_of[u]] = np.frombuffer(row[0], dtype=np.float32)
+            embedded[rows_of[u]] = True
+        else:
+            misses.append(u)
+    print(f"💾 {len(texts) - len(misses)} cached, {len(misses)} to embed.")
+
+    def store_batch(batch, embeddings):
+        new_rows = []
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        for idx, vec in zip(batch, vecs):
+            u = misses[idx]
+            mm[rows_of[u]] = vec
+            embedded[rows_of[u]] = True
+            new_rows.append((keys[u], vec.tobytes()))
+        # One transaction per batch: everything already paid for survives a crash
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", new_rows)
+
+    batches = make_batches([token_counts[u] for u in misses])
+    try:
+        asyncio.run(embed_all([texts[u] for u in misses], batches, store_batch))
+    except APIStatusError as e:
+        print(f"❌ Aborting: the embeddings API rejected the request ({e.status_code}). Check API_KEY, MODEL and base_url.")
+        cache.close()
+        del mm
+        os.remove(EMBEDDINGS_BUFFER)
+        sys.exit(1)
+    cache.close()
+    mm.flush()
+
+    # Never replace a working index with a partial or empty one; successes are
+    # cached, so a rerun only retries what failed
+    failed = sum(1 for u in misses if not embedded[rows_of[u][0]])
+    if failed or not embedded.any():
+        reason = f"{failed} of {len(texts)} unique chunks failed to embed" if failed else "no chunks to embed"
+        print(f"❌ Not writing {OUTPUT_FILE}: {reason}. Rerun to retry.")
+        del mm
+        os.remove(EMBEDDINGS_BUFFER)
+        sys.exit(1)
+
+    keep = np.flatnonzero(embedded)
+    all_chunks = [items[row][0] for row in keep]
+    metas = [items[row][1] for row in keep]
+    all_embeddings, scales = quantize(mm, keep)
+
+    save_archive(OUTPUT_FILE, chunks=all_chunks, embeddings=all_embeddings, scales=scales, metadata=metas)
+    del mm
+    os.remove(EMBEDDINGS_BUFFER)
     print(f"✅ Saved {len(all_chunks)} chunks to {OUTPUT_FILE}")
@@ -1,11 +1,16 @@
 import os
 import re
-import json
+import orjson
+import hashlib
 import requests
+import threading
 import mimetypes
 from tqdm import tqdm
+from pathlib import Path
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import google.generativeai as genai
 from playwright.sync_api import sync_playwright, TimeoutError
 
@@ -20,18 +25,48 @@ START_DATE = datetime(2025, 1, 1)
 END_DATE = datetime(2025, 4, 14)
 OUTPUT_JSON = "tds_discourse_json"
 OUTPUT_MARKDOWN = "tds_discourse_md"
+IMAGE_WORKERS = 8
+IMAGE_CACHE_FILE = "img_desc_cache.json"
 
 # --- Setup ---
 os.makedirs(OUTPUT_JSON, exist_ok=True)
 os.makedirs(OUTPUT_MARKDOWN, exist_ok=True)
 genai.configure(api_key=API_KEY)
 client = genai.GenerativeModel(MODEL)
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+
+# Shared keep-alive session so image downloads reuse TCP/TLS connections
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+# --- Image description cache (sha1 of image source -> description) ---
+def load_image_cache():
+    if os.path.exists(IMAGE_CACHE_FILE):
+        return orjson.loads(Path(IMAGE_CACHE_FILE).read_bytes())
+    return {}
+
+image_descriptions = load_image_cache()
+in_flight = {}  # sha1 -> Future, so concurrent requests for one image share a call
+cache_lock = threading.Lock()
+cache_dirty = False
+
+def save_image_cache():
+    global cache_dirty
+    with cache_lock:
+        if not cache_dirty:
+            return
+        tmp_path = f"{IMAGE_CACHE_FILE}.tmp"
+        Path(tmp_path).write_bytes(orjson.dumps(image_descriptions, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, IMAGE_CACHE_FILE)
+        cache_dirty = False
 
 # --- Gemini Image Understanding ---
 def describe_image(image_source):
     try:
         if image_source.startswith("http"):
-            image_bytes = requests.get(image_source).content
+            response = http.get(image_source, timeout=15)
+            response.raise_for_status()
+            image_bytes = response.content
             mime_type = mimetypes.guess_type(image_source)[0] or "image/jpeg"
         else:
             with open(image_source, "rb") as f:
@@ -48,27 +83,57 @@ def describe_image(image_source):
     except Exception as e:
         return f"[Image failed: {e}]"
 
+def describe_image_cached(image_source):
+    """Return a Future for the image description, reusing cached and in-flight results."""
+    key = hashlib.sha1(image_source.encode("utf-8")).hexdigest()
+    with cache_lock:
+        if key in image_descriptions:
+            future = Future()
+            future.set_result(image_descriptions[key])
+            return future
+        if key in in_flight:
+            return in_flight[key]
+        future = image_pool.submit(describe_image, image_source)
+        in_flight[key] = future
+
+    def store(done):
+        global cache_dirty
+        desc = done.result()
+        with cache_lock:
+            in_flight.pop(key, None)
+            if not desc.startswith("[Image failed:"):
+                image_descriptions[key] = desc
+                cache_dirty = True
+
+    future.add_done_callback(store)
+    return future
+
 # --- Convert HTML to Markdown with image understanding ---
 def convert_html_to_markdown(html: str, base_url: str = "", local_img_dir: str = "") -> str:
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, "lxml")
+    imgs, srcs = [], []
     for img in soup.find_all("img"):
         src = img.get("src", "")
         if not src:
             continue
         src_full = src if src.startswith("http") else os.path.join(local_img_dir if not src.startswith("/") else base_url, src)
-        desc = describe_image(src_full)
-        img.replace_with(desc)
+        imgs.append(img)
+        srcs.append(src_full)
+
+    # Describe images in parallel; repeated avatars/logos come from the cache
+    futures = {src: describe_image_cached(src) for src in dict.fromkeys(srcs)}
+    for img, src in zip(imgs, srcs):
+        img.replace_with(futures[src].result())
     return soup.get_text(separator="\n").strip()
 
 # --- Write Markdown file ---
 def save_markdown(content: str, title: str, url: str, output_file: str):
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write("---\n")
-        f.write(f"title: {title}\n")
-        f.write(f"original_url: {url}\n")
-        f.write(f"downloaded_at: {datetime.now().isoformat()}\n")
-        f.write("---\n\n")
-        f.write(content)
+    frontmatter = "\n".join([
+        f"title: {title}",
+        f"original_url: {url}",
+        f"downloaded_at: {datetime.now().isoformat()}",
+    ])
+    Path(output_file).write_text(f"---\n{frontmatter}\n---\n\n{content}", encoding="utf-8")
 
 # --- Parse Discourse date ---
 def parse_date(date_str):
@@ -77,6 +142,14 @@ def parse_date(date_str):
     except ValueError:
         return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
 
+# --- Resume support ---
+def is_up_to_date(topic, json_path, md_path):
+    # A topic is unchanged if it has no posts newer than the copy saved last run
+    if not (os.path.exists(json_path) and os.path.exists(md_path)):
+        return False
+    saved = orjson.loads(Path(json_path).read_bytes())
+    return saved.get("last_posted_at") == topic.get("last_posted_at")
+
 # --- Playwright-based scraping ---
 def login_and_save_auth(playwright):
     print("🔐 No auth found. Launching browser for manual login...")
@@ -95,11 +168,18 @@ def is_authenticated(page):
     try:
         page.goto(CATEGORY_JSON_URL, timeout=10000)
         page.wait_for_selector("pre", timeout=5000)
-        json.loads(page.inner_text("pre"))
+        orjson.loads(page.inner_text("pre"))
         return True
-    except (TimeoutError, json.JSONDecodeError):
+    except (TimeoutError, orjson.JSONDecodeError):
         return False
 
+# --- Read JSON rendered by the browser ---
+def read_page_json(page):
+    try:
+        return orjson.loads(page.inner_text("pre"))
+    except Exception:
+        return orjson.loads(page.content())
+
 # --- Main scrape logic ---
 def scrape_posts(playwright):
     print("🔍 Starting scrape using saved session...")
@@ -109,15 +189,13 @@ def scrape_posts(playwright):
 
     page_num = 0
     found_in_range = 0
+    skipped = 0
 
     while True:
         paginated_url = f"{CATEGORY_JSON_URL}?page={page_num}"
         print(f"📦 Fetching page {page_num}...")
         page.goto(paginated_url)
-        try:
-            data = json.loads(page.inner_text("pre"))
-        except:
-            data = json.loads(page.content())
+        data = read_page_json(page)
         topics = data.get("topic_list", {}).get("topics", [])
         if not topics:
             break
@@ -127,36 +205,43 @@ def scrape_posts(playwright):
             if not (START_DATE <= created_at <= END_DATE):
                 continue
 
-            topic_url = f"{BASE_URL}/t/{topic['slug']}/{topic['id']}.json"
-            page.goto(topic_url)
-            try:
-                topic_data = json.loads(page.inner_text("pre"))
-            except:
-                topic_data = json.loads(page.content())
-
             found_in_range += 1
 
             json_filename = f"{topic['id']}_{topic['slug']}.json"
-            with open(os.path.join(OUTPUT_JSON, json_filename), "w", encoding="utf-8") as f:
-                json.dump(topic_data, f, indent=2)
-
+            json_path = os.path.join(OUTPUT_JSON, json_filename)
             md_filename = f"{topic['id']}_{topic['slug']}.md"
             md_path = os.path.join(OUTPUT_MARKDOWN, md_filename)
+            if is_up_to_date(topic, json_path, md_path):
+                skipped += 1
+                continue
+
+            topic_url = f"{BASE_URL}/t/{topic['slug']}/{topic['id']}.json"
+            page.goto(topic_url)
+            topic_data = read_page_json(page)
+
             title = topic_data["title"].strip().replace("\n", "")
 
-            with open(md_path, "w", encoding="utf-8") as f:
-                f.write(f"# {title}\n\n")
-                f.write(f"*Original URL: {BASE_URL}/t/{topic['slug']}/{topic['id']}*\n")
-                f.write(f"*Posted on: {created_at.isoformat()}*\n\n")
-                for post in topic_data["post_stream"]["posts"]:
-                    username = post["username"]
-                    posted_at = datetime.strptime(post["created_at"], "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y-%m-%d %H:%M")
-                    content = convert_html_to_markdown(post["cooked"], base_url=BASE_URL)
-                    f.write(f"---\n**{username}** posted on {posted_at}:\n\n{content}\n\n")
+            # Build the whole file in memory and write it in one go
+            parts = [
+                f"# {title}\n\n",
+                f"*Original URL: {BASE_URL}/t/{topic['slug']}/{topic['id']}*\n",
+                f"*Posted on: {created_at.isoformat()}*\n\n",
+            ]
+            for post in topic_data["post_stream"]["posts"]:
+                username = post["username"]
+                posted_at = datetime.strptime(post["created_at"], "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y-%m-%d %H:%M")
+                content = convert_html_to_markdown(post["cooked"], base_url=BASE_URL)
+                parts.append(f"---\n**{username}** posted on {posted_at}:\n\n{content}\n\n")
+            Path(md_path).write_text("".join(parts), encoding="utf-8")
+            # Written last: is_up_to_date trusts this file's last_posted_at
+            Path(json_path).write_bytes(orjson.dumps(topic_data, option=orjson.OPT_INDENT_2))
+            save_image_cache()
 
         page_num += 1
 
-    print(f"✅ Completed. Total topics in date range: {found_in_range}")
+    image_pool.shutdown(wait=True)
+    save_image_cache()
+    print(f"✅ Completed. Total topics in date range: {found_in_range} ({skipped} unchanged, skipped)")
     browser.close()
 
 # --- Main Entrypoint ---
@@ -1,9 +1,11 @@
+import io
 import os
 import time
 import numpy as np
 from fastapi import FastAPI, Request
 from openai import OpenAI
 import tiktoken
+import zstandard as zstd
 from fastapi.middleware.cors import CORSMiddleware
 
 # --- Load env and setup ---
@@ -14,6 +16,10 @@ client = OpenAI(api_key=OPENAI_API_KEY, base_url="https://aipipe.org/openai/v1")
 EMBEDDING_MODEL = "text-embedding-3-small"
 LLM_MODEL = "gpt-3.5-turbo-0125"
 
+# --- Embedding archives (zstd-compressed npz, falling back to the legacy deflate npz) ---
+EMBEDDINGS_FILE = "embeddings.npz.zst"
+LEGACY_EMBEDDINGS_FILE = "embeddings.npz"
+
 class RateLimiter:
     def __init__(self, rpm=60, rps=3):
         self.rpm = rpm
@@ -46,9 +52,17 @@ app.add_middleware(
 
 def load_embeddings():
     try:
-        data = np.load("embeddings.npz", allow_pickle=True)
+        if os.path.exists(EMBEDDINGS_FILE):
+            with open(EMBEDDINGS_FILE, "rb") as f:
+                # Streamed archives have no content size in the frame header
+                raw = zstd.ZstdDecompressor().decompressobj().decompress(f.read())
+            data = np.load(io.BytesIO(raw), allow_pickle=True)
+        else:
+            data = np.load(LEGACY_EMBEDDINGS_FILE, allow_pickle=True)
         chunks = data["chunks"]
-        embeddings = np.array(data["embeddings"])
+        # int8-quantized rows only differ from float32 by a per-row scale,
+        # which cancels out in the cosine similarity used for retrieval
+        embeddings = data["embeddings"].astype(np.float32)
         metadata = data["metadata"]
         return chunks, embeddings, metadata
     except Exception as e: